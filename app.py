@@ -1,269 +1,357 @@
 #!/usr/bin/env python3
 
 import os
+import json
 import re
 import uuid
 import shutil
+import hashlib
+import threading
+import time
 import zipfile
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
 import requests
 from pathlib import Path
-from flask import Flask, render_template, request, send_file, jsonify
-from werkzeug.utils import secure_filename
+from flask import (Flask, Request, Response, render_template, request,
+                   jsonify, stream_with_context)
 from pypdf import PdfReader, PdfWriter
-import pdfplumber
+from pdf_backend import extract_page_texts, write_pages
+
+class _InMemoryRequest(Request):
+    """Request that keeps uploaded files in memory, not in temp files."""
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        # Uploads are capped by MAX_CONTENT_LENGTH, and the PDF is
+        # parsed from memory anyway
+        return BytesIO()
 
 app = Flask(__name__)
+app.request_class = _InMemoryRequest
 app.config['UPLOAD_FOLDER'] = '/tmp/pdf-processor/uploads'
 app.config['PROCESSING_FOLDER'] = '/tmp/pdf-processor/processing'
+app.config['CACHE_FOLDER'] = '/tmp/pdf-processor/cache'
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB max file size
 
+# Behind nginx, set this to an internal location that maps to
+# PROCESSING_FOLDER; downloads are then sent by nginx with sendfile(2)
+# instead of being streamed through Python
+app.config['ACCEL_REDIRECT_PREFIX'] = os.environ.get(
+    'ACCEL_REDIRECT_PREFIX', '').rstrip('/')
+
 # reCAPTCHA configuration
 RECAPTCHA_SITE_KEY = os.environ.get('RECAPTCHA_SITE_KEY', '')
 RECAPTCHA_SECRET_KEY = os.environ.get('RECAPTCHA_SECRET_KEY', '')
 RECAPTCHA_VERIFY_URL = 'https://www.google.com/recaptcha/api/siteverify'
 
+# Patterns used while scanning letters and naming output files
+_ENVELOPE_RE = re.compile(r'^(\d+)\s+Date Printed:')
+_PAGE_OF_RE = re.compile(r'Page\s+(\d+)\s+of\s+(\d+)')
+_FILENAME_BAD_RE = re.compile(r'[<>:"/\\|?*]')
+
+# Buffer size for file I/O; pypdf issues many small writes, which
+# this coalesces into 1 MiB syscalls
+_IO_BUFFER_SIZE = 1024 * 1024
+
+# Background processing of uploads.  Job status lives in a file in the
+# processing directory, since polls may reach another gunicorn worker.
+# The CPU-heavy letter writes already fan out to a process pool.
+_JOB_THREADS = 2
+_executor = ThreadPoolExecutor(max_workers=_JOB_THREADS)
+
+# Uploads with fewer letters than this are written in-process; forking
+# a pool that parses the master PDF in every worker would cost more
+_MIN_POOL_LETTERS = 8
+
+# Each queued job holds its whole upload in memory, so a gunicorn
+# worker turns uploads away once this many are queued or running
+_MAX_PENDING_JOBS = 4
+_pending_jobs = 0
+_pending_lock = threading.Lock()
+
+# A job still "processing" this many seconds after its last status
+# update, or whose gunicorn worker has exited, is reported as failed
+_MAX_JOB_RUNTIME = 30 * 60
+
+# Seconds to keep a job's files after handing its download to nginx
+_ACCEL_CLEANUP_DELAY = 60
+
+# Jobs that are never downloaded, or that failed, leave their
+# processing directory behind; remove those once they are this many
+# seconds old, checking every _REAP_INTERVAL seconds
+_MAX_JOB_AGE = 60 * 60
+_REAP_INTERVAL = 10 * 60
+
+# Cached results hold every family's letter, so do not keep them for
+# long: drop entries unused for this many seconds, and drop the least
+# recently used ones once the cache grows past _CACHE_MAX_BYTES
+_CACHE_MAX_AGE = 24 * 60 * 60
+_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
 # Ensure directories exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['PROCESSING_FOLDER'], exist_ok=True)
+os.makedirs(app.config['CACHE_FOLDER'], exist_ok=True)
 
-def extract_info(pdf_path):
+def extract_info(text):
     """
-    Extract the Family Envelope Number and Name from the first page of a PDF letter.
+    Extract the Family Envelope Number and Name from the text of the
+    first page of a letter.
     Returns a tuple (envelope_number, name).
     """
-    with pdfplumber.open(pdf_path) as pdf:
-        first_page = pdf.pages[0]
-        text = first_page.extract_text()
-
-        # Split text into lines
-        lines = text.split('\n')
+    # Split text into lines
+    lines = text.split('\n')
 
-        envelope_num = None
-        name = None
+    envelope_num = None
+    name = None
 
-        # Find the line before the address (which should contain the envelope number)
-        for i, line in enumerate(lines):
-            stripped = line.strip()
+    # Find the line before the address (which should contain the envelope number)
+    for i, line in enumerate(lines):
+        stripped = line.strip()
 
-            # Check for envelope number line
-            match = re.match(r'^(\d+)\s+Date Printed:', stripped)
-            if match:
-                envelope_num = int(match.group(1))
+        # Check for envelope number line
+        match = _ENVELOPE_RE.match(stripped)
+        if match:
+            envelope_num = int(match.group(1))
 
-                # The name should be on the next line
-                if i + 1 < len(lines):
-                    name = lines[i+1].strip()
-                break
+            # The name should be on the next line
+            if i + 1 < len(lines):
+                name = lines[i+1].strip()
+            break
 
     return envelope_num, name
 
+@lru_cache(maxsize=4096)
 def sanitize_filename(name):
     """Sanitize a string to be safe for filenames."""
     # Remove invalid characters
-    s = re.sub(r'[<>:"/\\|?*]', '', name)
+    s = _FILENAME_BAD_RE.sub('', name)
     # Replace spaces with underscores
     s = s.replace(' ', '_')
     return s
 
-def split_pdf_into_letters(input_pdf_path, output_folder):
+@dataclass
+class Letter:
+    """A single letter found in the master PDF."""
+    start: int
+    end: int
+    first_text: str
+    total: int
+
+    @property
+    def page_count(self):
+        """Number of pages in this letter."""
+        return self.end - self.start
+
+def scan_letters(page_texts):
     """
-    Split a master PDF into individual letter PDFs.
+    Group the pages of a master PDF into letters, given the text of
+    each page.
     Uses "Page x of y" footer to determine letter boundaries.
+    Returns a list of Letter objects, in document order.
+    """
+    letters = []
+    current = None
+
+    # This loop runs once per page; skip the attribute lookup each time
+    find_page_of = _PAGE_OF_RE.search
+
+    for page_num, text in enumerate(page_texts):
+        # Look for "Page X of Y" pattern
+        page_match = find_page_of(text)
+
+        if page_match:
+            current_page_num, total_pages = map(int, page_match.groups())
+
+            if current_page_num == 1 or current is None:
+                # Start of a new letter; keep any unfinished one
+                if current is not None:
+                    letters.append(current)
+                current = Letter(start=page_num, end=page_num + 1,
+                                 first_text=text, total=total_pages)
+            else:
+                # Continuation of current letter
+                current.end = page_num + 1
+
+            # Check if we've reached the last page
+            if current_page_num == total_pages:
+                letters.append(current)
+                current = None
+        elif current is not None:
+            # Fallback: if we can't find the page number, but we
+            # have pages accumulating
+            current.end = page_num + 1
+
+    # Handle any remaining pages (if last letter didn't end properly)
+    if current is not None:
+        letters.append(current)
+
+    return letters
+
+# Master PDF reader and output scratch buffer for this letter-writer
+# process
+_worker_reader = None
+_worker_scratch = None
+
+def _init_letter_worker(pdf_bytes):
+    """Open the master PDF once in each letter-writer process."""
+    global _worker_reader, _worker_scratch
+    _worker_reader = PdfReader(BytesIO(pdf_bytes))
+    _worker_scratch = BytesIO()
+
+def _write_letter(task):
+    """Write a (start, end) range of master PDF pages to a new file."""
+    page_range, filepath = task
+    write_pages(_worker_reader, page_range, filepath, _worker_scratch)
+
+def _available_cpus():
+    """
+    Count the CPUs this process may use, honoring CPU affinity and a
+    cgroup v2 CPU quota (as set by "docker run --cpus").
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            cpus = min(cpus, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+
+    return cpus
+
+def split_pdf_into_letters(letters, pdf_bytes, output_folder):
+    """
+    Write each scanned letter to its own PDF in output_folder.
+    pdf_bytes is the content of the master PDF the letters came from.
     Returns a dictionary mapping Family Envelope Number to filename.
     """
     # Create output folder if it doesn't exist
     output_path = Path(output_folder)
     output_path.mkdir(parents=True, exist_ok=True)
 
-    # Read the input PDF
-    reader = PdfReader(input_pdf_path)
-
     # Dictionary to store the mapping
     family_mapping = {}
 
-    # Track pages for current letter
-    current_letter_pages = []
-    current_page_count = 0
-    total_pages_in_letter = 0
-
-    def save_letter(pages):
-        """Helper to save a list of pages as a PDF."""
-        # Create a temporary writer to extract info
-        temp_writer = PdfWriter()
-        temp_writer.add_page(pages[0])
-
-        # We need to save to a temp file to use pdfplumber for extraction
-        temp_filename = output_path / "temp_extract.pdf"
-        with open(temp_filename, 'wb') as f:
-            temp_writer.write(f)
-
-        envelope_num, name = extract_info(temp_filename)
-
-        # Clean up temp file
-        if temp_filename.exists():
-            os.remove(temp_filename)
+    # Filenames handed out so far; the files themselves are written
+    # later, in parallel, into a fresh output folder
+    used_names = set()
 
+    def choose_filename(envelope_num, name):
+        """Helper to pick a unique filename for a letter."""
         if name:
             safe_name = sanitize_filename(name)
             # Include envelope number to help ensure uniqueness
             if envelope_num:
-                filename = f"{envelope_num}_{safe_name}.pdf"
+                stem = f"{envelope_num}_{safe_name}"
             else:
-                filename = f"{safe_name}.pdf"
+                stem = safe_name
         else:
             # Fallback if name not found
-            filename = f"letter_unknown_{len(family_mapping)}.pdf"
+            stem = f"letter_unknown_{len(family_mapping)}"
 
-        filepath = output_path / filename
-
-        # Ensure filename is unique - add counter if file exists
+        # Ensure filename is unique - add counter if already taken
+        filename = f"{stem}.pdf"
         counter = 1
-        while filepath.exists():
-            if name:
-                safe_name = sanitize_filename(name)
-                if envelope_num:
-                    filename = f"{envelope_num}_{safe_name}_{counter}.pdf"
-                else:
-                    filename = f"{safe_name}_{counter}.pdf"
-            else:
-                filename = f"letter_unknown_{len(family_mapping)}_{counter}.pdf"
-            filepath = output_path / filename
+        while filename in used_names:
+            filename = f"{stem}_{counter}.pdf"
             counter += 1
 
-        # Write the full letter
-        writer = PdfWriter()
-        for p in pages:
-            writer.add_page(p)
-
-        with open(filepath, 'wb') as f:
-            writer.write(f)
-
-        return filename, envelope_num, name, len(pages)
-
-    # Process each page
-    for page_num, page in enumerate(reader.pages):
-        text = page.extract_text() or ""
+        used_names.add(filename)
+        return filename
 
-        # Look for "Page X of Y" pattern
-        page_match = re.search(r'Page\s+(\d+)\s+of\s+(\d+)', text)
-
-        if page_match:
-            current_page_num = int(page_match.group(1))
-            total_pages = int(page_match.group(2))
-
-            if current_page_num == 1:
-                # Start of a new letter
-                if current_letter_pages:
-                    current_letter_pages = []
-
-                current_letter_pages.append(page)
-                total_pages_in_letter = total_pages
-
-                # If it's a 1-page letter, save immediately
-                if total_pages == 1:
-                    filename, envelope_num, name, page_count = save_letter(current_letter_pages)
-                    if envelope_num:
-                        family_mapping[envelope_num] = {
-                            'filename': filename,
-                            'salutation': name,
-                            'page_count': page_count
-                        }
-                    current_letter_pages = []
-                    total_pages_in_letter = 0
-            else:
-                # Continuation of current letter
-                current_letter_pages.append(page)
-
-                # Check if we've reached the last page
-                if current_page_num == total_pages:
-                    filename, envelope_num, name, page_count = save_letter(current_letter_pages)
-                    if envelope_num:
-                        family_mapping[envelope_num] = {
-                            'filename': filename,
-                            'salutation': name,
-                            'page_count': page_count
-                        }
-                    current_letter_pages = []
-                    total_pages_in_letter = 0
-        else:
-            # Fallback: if we can't find the page number, but we have pages accumulating
-            if current_letter_pages:
-                current_letter_pages.append(page)
+    tasks = []
+    for letter in letters:
+        envelope_num, name = extract_info(letter.first_text)
+        filename = choose_filename(envelope_num, name)
+        tasks.append(((letter.start, letter.end),
+                      str(output_path / filename)))
 
-    # Handle any remaining pages (if last letter didn't end properly)
-    if current_letter_pages:
-        filename, envelope_num, name, page_count = save_letter(current_letter_pages)
         if envelope_num:
             family_mapping[envelope_num] = {
                 'filename': filename,
                 'salutation': name,
-                'page_count': page_count
+                'page_count': letter.page_count
             }
 
+    # Letters are independent and writing them is CPU-bound, so spread
+    # them across the cores this job may use; the other job threads
+    # in this gunicorn worker get their share too
+    workers = min(_available_cpus() // _JOB_THREADS, len(tasks))
+    if workers <= 1 or len(tasks) < _MIN_POOL_LETTERS:
+        reader = PdfReader(BytesIO(pdf_bytes))
+        scratch = BytesIO()
+        for page_range, filepath in tasks:
+            write_pages(reader, page_range, filepath, scratch)
+        return family_mapping
+
+    chunksize = max(1, len(tasks) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_letter_worker,
+                             initargs=(pdf_bytes,)) as executor:
+        # Consume the results so worker exceptions are raised here
+        list(executor.map(_write_letter, tasks, chunksize=chunksize))
+
     return family_mapping
 
-def create_even_page_pdf(input_pdf_path, output_pdf_path, family_mapping):
+def even_page_runs(page_ranges):
     """
-    Create a new PDF with blank pages inserted after odd-page letters
-    to ensure each letter has an even number of pages.
+    Group letters' (start, end) page ranges into runs that can be
+    copied in one go.  Back-to-back letters that need no blank page
+    are merged into a single run.
+    Yields (start, end, needs_blank) tuples.
     """
-    reader = PdfReader(input_pdf_path)
-    writer = PdfWriter()
+    run_start = None
+    prev_end = None
 
-    # We need to track which letters have odd pages
-    # and insert blank pages after them
+    for start, end in page_ranges:
+        # A gap in the master PDF ends the current run
+        if run_start is not None and start != prev_end:
+            yield run_start, prev_end, False
+            run_start = None
 
-    # First, parse the original PDF to identify letter boundaries
-    current_letter_pages = []
-    letters_info = []
+        if run_start is None:
+            run_start = start
+        prev_end = end
 
-    for page_num, page in enumerate(reader.pages):
-        text = page.extract_text() or ""
-        page_match = re.search(r'Page\s+(\d+)\s+of\s+(\d+)', text)
+        # An odd-page letter ends the run, followed by a blank page
+        if (end - start) % 2 == 1:
+            yield run_start, end, True
+            run_start = None
 
-        if page_match:
-            current_page_num = int(page_match.group(1))
-            total_pages = int(page_match.group(2))
-
-            if current_page_num == 1:
-                # Save previous letter if exists
-                if current_letter_pages:
-                    letters_info.append(current_letter_pages)
-                current_letter_pages = [page]
-
-                if total_pages == 1:
-                    letters_info.append(current_letter_pages)
-                    current_letter_pages = []
-            else:
-                current_letter_pages.append(page)
+    if run_start is not None:
+        yield run_start, prev_end, False
 
-                if current_page_num == total_pages:
-                    letters_info.append(current_letter_pages)
-                    current_letter_pages = []
-        else:
-            if current_letter_pages:
-                current_letter_pages.append(page)
-
-    # Handle remaining pages
-    if current_letter_pages:
-        letters_info.append(current_letter_pages)
+def create_even_page_pdf(reader, page_ranges, output_pdf_path):
+    """
+    Create a new PDF with blank pages inserted after odd-page letters
+    to ensure each letter has an even number of pages.
+    page_ranges holds a (start, end) tuple of page indices per letter.
+    """
+    writer = PdfWriter()
 
-    # Now create the new PDF with blank pages inserted as needed
-    for letter_pages in letters_info:
-        # Add all pages of the letter
-        for page in letter_pages:
-            writer.add_page(page)
+    for start, end, needs_blank in even_page_runs(page_ranges):
+        # Add all pages of the run of letters
+        writer.append(reader, pages=(start, end), import_outline=False)
 
-        # If the letter has an odd number of pages, add a blank page
-        if len(letter_pages) % 2 == 1:
+        # If the run ends in an odd-page letter, add a blank page
+        if needs_blank:
             # Create a blank page with the same dimensions as the last page
-            blank_page = writer.add_blank_page(
-                width=letter_pages[-1].mediabox.width,
-                height=letter_pages[-1].mediabox.height
+            last_page = reader.pages[end - 1]
+            writer.add_blank_page(
+                width=last_page.mediabox.width,
+                height=last_page.mediabox.height
             )
 
     # Write the output PDF
-    with open(output_pdf_path, 'wb') as f:
+    with open(output_pdf_path, 'wb', buffering=_IO_BUFFER_SIZE) as f:
         writer.write(f)
 
 def verify_recaptcha(token):
@@ -295,23 +383,374 @@ def verify_recaptcha(token):
         app.logger.error(f"reCAPTCHA verification error: {e}")
         return False
 
-def create_zip_file(processing_dir, zip_filename):
-    """Create a zip file containing all generated PDFs."""
-    zip_path = Path(processing_dir) / zip_filename
+def zip_members(processing_dir):
+    """
+    List the generated PDFs that belong in the download zip.
+    Returns a list of (path, arcname) tuples.
+    """
+    members = []
 
-    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        # Add individual letters
-        letters_dir = Path(processing_dir) / 'individual-letters'
-        if letters_dir.exists():
-            for pdf_file in letters_dir.glob('*.pdf'):
-                zipf.write(pdf_file, f'individual-letters/{pdf_file.name}')
+    # Add individual letters
+    letters_dir = Path(processing_dir) / 'individual-letters'
+    if letters_dir.exists():
+        for pdf_file in sorted(letters_dir.glob('*.pdf')):
+            members.append(
+                (pdf_file, f'individual-letters/{pdf_file.name}'))
 
-        # Add even-page PDF
-        even_page_pdf = Path(processing_dir) / 'even_page_letters.pdf'
-        if even_page_pdf.exists():
-            zipf.write(even_page_pdf, 'even_page_letters.pdf')
+    # Add even-page PDF
+    even_page_pdf = Path(processing_dir) / 'even_page_letters.pdf'
+    if even_page_pdf.exists():
+        members.append((even_page_pdf, 'even_page_letters.pdf'))
 
-    return zip_path
+    return members
+
+class _ZipChunkBuffer:
+    """Write-only file object that collects zip output for streaming."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        """Return and forget everything written so far."""
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def iter_zip_chunks(processing_dir):
+    """
+    Generate a zip of all generated PDFs, chunk by chunk.
+    Nothing is staged on disk; the zip is built as it is sent.
+    """
+    buf = _ZipChunkBuffer()
+
+    # The buffer cannot seek, so zipfile writes data descriptors
+    # after each member instead of going back to patch its header
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED) as zipf:
+        for path, arcname in zip_members(processing_dir):
+            # PDF content streams are already Flate-compressed, so
+            # deflating them again costs CPU and saves almost nothing
+            zinfo = zipfile.ZipInfo.from_file(path, arcname)
+            zinfo.compress_type = zipfile.ZIP_STORED
+            with open(path, 'rb') as src, zipf.open(zinfo, 'w') as dest:
+                while chunk := src.read(_IO_BUFFER_SIZE):
+                    dest.write(chunk)
+                    yield buf.drain()
+            yield buf.drain()
+
+    # Central directory
+    yield buf.drain()
+
+def write_zip_file(processing_dir):
+    """Stage the download zip on disk, for nginx to send."""
+    zip_path = Path(processing_dir) / 'processed_letters.zip'
+    with open(zip_path, 'wb', buffering=_IO_BUFFER_SIZE) as f:
+        for chunk in iter_zip_chunks(processing_dir):
+            f.write(chunk)
+
+def process_pdf(pdf_bytes, processing_dir):
+    """
+    Run the full pipeline on the content of an uploaded master PDF.
+    Leaves the generated PDFs in processing_dir and returns the
+    family mapping.
+    """
+    processing_dir = Path(processing_dir)
+
+    # Create output directories
+    individual_letters_dir = processing_dir / 'individual-letters'
+    individual_letters_dir.mkdir(exist_ok=True)
+
+    # Find the letter boundaries once; both steps below share them
+    letters = scan_letters(extract_page_texts(pdf_bytes))
+    reader = PdfReader(BytesIO(pdf_bytes))
+
+    # Step 1: Split into individual letters
+    family_mapping = split_pdf_into_letters(
+        letters,
+        pdf_bytes,
+        str(individual_letters_dir)
+    )
+
+    # Step 2: Create even-page PDF
+    even_page_pdf = processing_dir / 'even_page_letters.pdf'
+    page_ranges = [(letter.start, letter.end) for letter in letters]
+    create_even_page_pdf(reader, page_ranges, str(even_page_pdf))
+
+    return family_mapping
+
+def _link_or_copy(src, dst):
+    """Hard link src to dst, copying if they are on different mounts."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def load_cached_result(digest, processing_dir):
+    """
+    Link the cached PDFs for a master PDF digest into processing_dir.
+    Returns the cached family mapping, or None if nothing is cached.
+    """
+    cache_dir = Path(app.config['CACHE_FOLDER']) / digest
+    if not cache_dir.is_dir():
+        return None
+
+    # Links are cheap, and removing processing_dir after the download
+    # leaves the cached copy intact
+    try:
+        shutil.copytree(cache_dir, processing_dir,
+                        copy_function=_link_or_copy, dirs_exist_ok=True)
+        with open(cache_dir / 'family_mapping.json') as f:
+            family_mapping = json.load(f)
+    except (OSError, shutil.Error):
+        # The reaper removed the entry while we were copying it; drop
+        # whatever made it across and process the upload afresh
+        for path, arcname in zip_members(processing_dir):
+            path.unlink(missing_ok=True)
+        return None
+
+    # Mark the entry as recently used, so the reaper keeps it
+    os.utime(cache_dir)
+    return family_mapping
+
+def store_cached_result(digest, processing_dir, family_mapping):
+    """Save the generated PDFs and their family mapping in the cache."""
+    cache_root = Path(app.config['CACHE_FOLDER'])
+    tmp_dir = cache_root / f'{uuid.uuid4()}.tmp'
+
+    for path, arcname in zip_members(processing_dir):
+        dest = tmp_dir / arcname
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        _link_or_copy(path, dest)
+
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    with open(tmp_dir / 'family_mapping.json', 'w') as f:
+        json.dump(family_mapping, f)
+
+    # Move the entry into place atomically so concurrent workers never
+    # see a partial one; if another worker got there first, keep theirs
+    try:
+        os.replace(tmp_dir, cache_root / digest)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def write_status(processing_dir, **status):
+    """Atomically record the status of a job in its directory."""
+    status['updated'] = time.time()
+    tmp_path = Path(processing_dir) / 'status.json.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(status, f)
+    os.replace(tmp_path, Path(processing_dir) / 'status.json')
+
+def read_status(processing_dir):
+    """Return the recorded status of a job, or None if there is none."""
+    try:
+        with open(Path(processing_dir) / 'status.json') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def _job_is_stale(status):
+    """Check whether a "processing" job has been abandoned."""
+    if time.time() - status.get('updated', 0) > _MAX_JOB_RUNTIME:
+        return True
+
+    # The gunicorn worker running the job may have died or been
+    # recycled; signal 0 only checks that the process still exists
+    try:
+        os.kill(status.get('pid', 0), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+def current_status(processing_dir):
+    """
+    Return the recorded status of a job, or None if there is none.
+    Abandoned jobs are reported as failed.
+    """
+    status = read_status(processing_dir)
+    if (status is not None and status['status'] == 'processing'
+            and _job_is_stale(status)):
+        status = {
+            'status': 'error',
+            'error': 'Processing was interrupted. Please try again.'
+        }
+    return status
+
+def _reserve_job_slot():
+    """Claim a pending job slot; returns False if none are free."""
+    global _pending_jobs
+    with _pending_lock:
+        if _pending_jobs >= _MAX_PENDING_JOBS:
+            return False
+        _pending_jobs += 1
+        return True
+
+def _release_job_slot():
+    """Give back a slot claimed by _reserve_job_slot()."""
+    global _pending_jobs
+    with _pending_lock:
+        _pending_jobs -= 1
+
+def remove_processing_dir(processing_dir):
+    """Delete a job's processing directory, logging any failure."""
+    try:
+        if processing_dir.exists():
+            shutil.rmtree(processing_dir)
+    except Exception as e:
+        app.logger.error(f"Error cleaning up {processing_dir}: {e}")
+
+def schedule_cleanup(processing_dir, delay=0):
+    """Remove a job's processing directory later, off this thread."""
+    timer = threading.Timer(delay, remove_processing_dir,
+                            (processing_dir,))
+    timer.daemon = True
+    timer.start()
+
+def reap_processing_dirs():
+    """
+    Remove processing directories untouched for _MAX_JOB_AGE.
+    Age comes from status.json, which is rewritten on every status
+    change and touched when a download starts; the directory's own
+    mtime does not change while letters are written or downloaded.
+    Jobs that are still processing are left alone.
+    """
+    cutoff = time.time() - _MAX_JOB_AGE
+    for path in Path(app.config['PROCESSING_FOLDER']).iterdir():
+        # Jobs only ever create directories here; leave anything else
+        # (e.g. on a mounted host volume) alone
+        if not path.is_dir():
+            continue
+
+        try:
+            try:
+                mtime = (path / 'status.json').stat().st_mtime
+            except FileNotFoundError:
+                # No status written yet
+                mtime = path.stat().st_mtime
+            if mtime >= cutoff:
+                continue
+
+            try:
+                status = current_status(path)
+            except ValueError:
+                # Corrupt status.json; no job can use this directory
+                status = None
+            if status is not None and status['status'] == 'processing':
+                continue
+
+            shutil.rmtree(path, ignore_errors=True)
+        except FileNotFoundError:
+            # Another gunicorn worker removed it first
+            pass
+        except (OSError, ValueError) as e:
+            # Keep going; one bad entry must not stop the whole pass
+            app.logger.error(f"Error reaping {path}: {e}")
+
+def _dir_size(path):
+    """Return the total size in bytes of the files under path."""
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.stat(os.path.join(root, name)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+def reap_cache():
+    """
+    Remove cache entries older than _CACHE_MAX_AGE, then the least
+    recently used ones until the cache fits in _CACHE_MAX_BYTES.
+    """
+    now = time.time()
+    entries = []
+
+    for path in Path(app.config['CACHE_FOLDER']).iterdir():
+        try:
+            age = now - path.stat().st_mtime
+        except FileNotFoundError:
+            # Another gunicorn worker removed it first
+            continue
+
+        if path.name.endswith('.tmp'):
+            # An entry still being written; only remove it if its
+            # writer must have died
+            if age > _MAX_JOB_AGE:
+                shutil.rmtree(path, ignore_errors=True)
+        elif age > _CACHE_MAX_AGE:
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            entries.append((age, path))
+
+    # Keep the most recently used entries that fit
+    total = 0
+    for age, path in sorted(entries):
+        total += _dir_size(path)
+        if total > _CACHE_MAX_BYTES:
+            shutil.rmtree(path, ignore_errors=True)
+
+def _reaper_loop():
+    """Periodically reap abandoned processing directories and cache."""
+    while True:
+        # Reap each separately, so a failure in one never stops the
+        # other; the cache holds family names and addresses, and must
+        # expire no matter what
+        for reap in (reap_processing_dirs, reap_cache):
+            try:
+                reap()
+            except Exception as e:
+                app.logger.error(f"Error in {reap.__name__}: {e}")
+        time.sleep(_REAP_INTERVAL)
+
+def read_upload(file):
+    """
+    Get the content of an upload, which _InMemoryRequest has already
+    buffered in a BytesIO, and hash it in a single pass.
+    Returns a tuple (content, SHA-256 hex digest).
+    """
+    data = file.stream.getvalue()
+    return data, hashlib.sha256(data).hexdigest()
+
+def run_job(pdf_bytes, digest, processing_dir):
+    """Process an uploaded PDF in the background, recording its status."""
+    try:
+        if not Path(processing_dir).is_dir():
+            # Reaped while the job sat in the queue
+            app.logger.error(f"Dropping job for missing {processing_dir}")
+            return
+
+        # Restart the stale-job clock now that the job is running
+        write_status(processing_dir, status='processing',
+                     pid=os.getpid())
+
+        # Reuse the result of an earlier upload of the same PDF
+        family_mapping = load_cached_result(digest, processing_dir)
+        if family_mapping is None:
+            family_mapping = process_pdf(pdf_bytes, processing_dir)
+            store_cached_result(digest, processing_dir, family_mapping)
+
+        if app.config['ACCEL_REDIRECT_PREFIX']:
+            write_zip_file(processing_dir)
+
+        write_status(processing_dir, status='done',
+                     letters_count=len(family_mapping))
+    except Exception as e:
+        app.logger.error(f"Error processing {processing_dir}: {e}")
+        try:
+            write_status(processing_dir, status='error', error=str(e))
+        except OSError as e:
+            app.logger.error(f"Error recording failure of "
+                             f"{processing_dir}: {e}")
+    finally:
+        _release_job_slot()
 
 @app.route('/')
 def index():
@@ -328,96 +767,127 @@ Disallow: /
 @app.route('/upload', methods=['POST'])
 def upload_file():
     """Handle file upload and processing."""
-    # Verify reCAPTCHA
-    recaptcha_token = request.form.get('recaptcha_token', '')
-    if not verify_recaptcha(recaptcha_token):
-        return jsonify({'error': 'reCAPTCHA verification failed. Please try again.'}), 400
+    # Turn uploads away rather than queueing them without bound.  This
+    # comes first: request.form and request.files would read the
+    # whole body (up to 100MB) into memory.
+    if not _reserve_job_slot():
+        return jsonify({
+            'error': 'The server is busy. Please try again in a few minutes.'
+        }), 503
 
-    if 'pdf' not in request.files:
-        return jsonify({'error': 'No file uploaded'}), 400
+    submitted = False
+    try:
+        # Verify reCAPTCHA
+        recaptcha_token = request.form.get('recaptcha_token', '')
+        if not verify_recaptcha(recaptcha_token):
+            return jsonify({'error': 'reCAPTCHA verification failed. Please try again.'}), 400
 
-    file = request.files['pdf']
+        if 'pdf' not in request.files:
+            return jsonify({'error': 'No file uploaded'}), 400
 
-    if file.filename == '':
-        return jsonify({'error': 'No file selected'}), 400
+        file = request.files['pdf']
 
-    if not file.filename.lower().endswith('.pdf'):
-        return jsonify({'error': 'File must be a PDF'}), 400
+        if file.filename == '':
+            return jsonify({'error': 'No file selected'}), 400
+
+        if not file.filename.lower().endswith('.pdf'):
+            return jsonify({'error': 'File must be a PDF'}), 400
 
-    try:
         # Create unique processing directory
         process_id = str(uuid.uuid4())
         processing_dir = Path(app.config['PROCESSING_FOLDER']) / process_id
         processing_dir.mkdir(parents=True, exist_ok=True)
 
-        # Save uploaded file
-        filename = secure_filename(file.filename)
-        upload_path = processing_dir / filename
-        file.save(upload_path)
+        # The upload is already in memory; work from it directly
+        pdf_bytes, digest = read_upload(file)
 
-        # Create output directories
-        individual_letters_dir = processing_dir / 'individual-letters'
-        individual_letters_dir.mkdir(exist_ok=True)
+        # Process in the background; the client polls /status
+        write_status(processing_dir, status='processing',
+                     pid=os.getpid())
+        _executor.submit(run_job, pdf_bytes, digest, processing_dir)
+        submitted = True
 
-        # Step 1: Split into individual letters
-        family_mapping = split_pdf_into_letters(
-            str(upload_path),
-            str(individual_letters_dir)
-        )
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-        # Step 2: Create even-page PDF
-        even_page_pdf = processing_dir / 'even_page_letters.pdf'
-        create_even_page_pdf(
-            str(upload_path),
-            str(even_page_pdf),
-            family_mapping
-        )
+    finally:
+        # Once submitted, run_job() gives the slot back
+        if not submitted:
+            _release_job_slot()
 
-        # Step 3: Create zip file
-        zip_filename = 'processed_letters.zip'
-        zip_path = create_zip_file(processing_dir, zip_filename)
+    # Return the process_id so the client can poll and download
+    return jsonify({
+        'success': True,
+        'process_id': process_id,
+        'status': 'processing'
+    })
 
-        # Return the process_id so the client can download the zip
-        return jsonify({
-            'success': True,
-            'process_id': process_id,
-            'letters_count': len(family_mapping)
-        })
+@app.route('/status/<process_id>')
+def job_status(process_id):
+    """Report whether an uploaded PDF has finished processing."""
+    processing_dir = Path(app.config['PROCESSING_FOLDER']) / process_id
+    status = current_status(processing_dir)
 
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    if status is None:
+        return jsonify({'error': 'Unknown process ID'}), 404
+
+    # Leave out internal bookkeeping, such as the worker pid
+    public_fields = ('status', 'letters_count', 'error')
+    return jsonify({k: v for k, v in status.items() if k in public_fields})
 
 @app.route('/download/<process_id>')
 def download_file(process_id):
     """Download the processed zip file."""
     try:
         processing_dir = Path(app.config['PROCESSING_FOLDER']) / process_id
-        zip_path = processing_dir / 'processed_letters.zip'
+        status = current_status(processing_dir)
 
-        if not zip_path.exists():
+        if status is None:
             return jsonify({'error': 'File not found'}), 404
-
-        # Send file and schedule cleanup
-        response = send_file(
-            zip_path,
-            as_attachment=True,
-            download_name='processed_letters.zip',
-            mimetype='application/zip'
+        if status['status'] == 'error':
+            return jsonify({'error': status['error']}), 500
+        if status['status'] == 'processing':
+            return jsonify({'error': 'Processing is not finished'}), 409
+
+        # Keep the reaper away while the download is in progress
+        os.utime(processing_dir / 'status.json')
+
+        headers = {
+            'Content-Disposition':
+                'attachment; filename=processed_letters.zip'
+        }
+
+        prefix = app.config['ACCEL_REDIRECT_PREFIX']
+        if prefix:
+            # Have nginx send the staged zip with sendfile(2).  nginx
+            # opens the file only after this response is complete, so
+            # give it a while before cleaning up.
+            headers['X-Accel-Redirect'] = (
+                f'{prefix}/{process_id}/processed_letters.zip')
+            schedule_cleanup(processing_dir, _ACCEL_CLEANUP_DELAY)
+            return Response(mimetype='application/zip', headers=headers)
+
+        # Build the zip while sending it, and schedule cleanup
+        response = Response(
+            stream_with_context(iter_zip_chunks(processing_dir)),
+            mimetype='application/zip',
+            headers=headers
         )
 
-        # Clean up the processing directory after sending the file
+        # Clean up the processing directory after sending the file,
+        # without holding up this worker
         @response.call_on_close
         def cleanup():
-            try:
-                if processing_dir.exists():
-                    shutil.rmtree(processing_dir)
-            except Exception as e:
-                app.logger.error(f"Error cleaning up {processing_dir}: {e}")
+            schedule_cleanup(processing_dir)
 
         return response
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Reap now, to clear out anything left from before a restart, and then
+# periodically
+threading.Thread(target=_reaper_loop, daemon=True).start()
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=False)
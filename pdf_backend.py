@@ -0,0 +1,57 @@
+"""
+Page-level PDF I/O used by the letter processor.
+
+Text extraction goes through PDFium (via pypdfium2), which is native
+code and much faster than pypdf's pure-Python content stream parser.
+Writing pages stays with pypdf.
+"""
+
+import threading
+import pypdfium2 as pdfium
+from pypdf import PdfWriter
+
+# PDFium is not thread-safe, and uploads are processed in threads
+_pdfium_lock = threading.Lock()
+
+def extract_page_texts(src):
+    """
+    Extract the text of every page of a PDF.
+    src may be a path, bytes, or a binary file object.
+    Returns a list of strings, one per page.
+    """
+    texts = []
+
+    with _pdfium_lock:
+        pdf = pdfium.PdfDocument(src)
+        try:
+            for i in range(len(pdf)):
+                page = pdf[i]
+                textpage = page.get_textpage()
+                texts.append(textpage.get_text_range())
+                textpage.close()
+                page.close()
+        finally:
+            pdf.close()
+
+    return texts
+
+def write_pages(reader, page_range, out_path, scratch):
+    """
+    Write a (start, end) range of pages from a pypdf PdfReader to a
+    new PDF file at out_path.
+    scratch is a BytesIO that is reused from call to call, so its
+    memory does not have to be reallocated for every file.
+    """
+    writer = PdfWriter()
+    writer.append(reader, pages=page_range, import_outline=False)
+
+    # Overwrite from the start rather than truncating, which could
+    # shrink the buffer; bytes past this file's length are left over
+    # from an earlier, larger one
+    scratch.seek(0)
+    writer.write(scratch)
+    length = scratch.tell()
+
+    # Hand the whole file to the OS in one write
+    with open(out_path, 'wb') as f, scratch.getbuffer() as view:
+        f.write(view[:length])